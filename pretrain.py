@@ -1,10 +1,14 @@
 from models.geco import build_model
-from utils.box_ops import compute_location, BoxList
+from utils.box_ops import compute_location
 from utils.data import FSC147Dataset
 from utils.arg_parser import get_argparser
-from utils.losses import ObjectNormalizedL2Loss, Detection_criterion
+from utils.losses import ObjectNormalizedL2Loss, Detection_criterion, ae_and_sqe
 from time import perf_counter
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import contextlib
+import math
 import os
 
 import torch
@@ -12,18 +16,25 @@ from torch import nn
 from torch.utils.data import DataLoader, DistributedSampler
 from torch.nn.parallel import DistributedDataParallel
 from torch import distributed as dist
-from utils.data import pad_collate
+from utils.data import pad_collate, seed_worker, Prefetcher
 import numpy as np
 import random
 
 
-torch.manual_seed(0)
-random.seed(0)
-np.random.seed(0)
-
 DATASETS = {"fsc147": FSC147Dataset}
 
 
+def to_cpu(obj):
+    if torch.is_tensor(obj):
+        # always copy, cpu tensors (e.g. optimizer steps) keep changing in place
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
 def train(args):
     if "SLURM_PROCID" in os.environ:
         world_size = int(os.environ["SLURM_NTASKS"])
@@ -35,36 +46,76 @@ def train(args):
         rank = int(os.environ["RANK"])
         gpu = int(os.environ["LOCAL_RANK"])
 
+    # seed by rank so that ranks do not draw identical augmentations
+    torch.manual_seed(rank)
+    random.seed(rank)
+    np.random.seed(rank)
+
     torch.cuda.set_device(gpu)
     device = torch.device(gpu)
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
 
     dist.init_process_group(
         backend="nccl", init_method="env://", world_size=world_size, rank=rank
     )
 
+    model = build_model(args).to(device, memory_format=torch.channels_last)
+    if args.compile:
+        # compile in place so the checkpoint keys stay unchanged
+        model.compile(mode="reduce-overhead", dynamic=False)
+    elif args.cuda_graph and args.backbone_lr == 0:
+        model.backbone.cuda_graph = True
     model = DistributedDataParallel(
-        build_model(args).to(device), device_ids=[gpu], output_device=gpu
+        model,
+        device_ids=[gpu],
+        output_device=gpu,
+        gradient_as_bucket_view=True,
+        bucket_cap_mb=100,
+    )
+    # graph capture does not support the autocast weight cache
+    autocast = partial(
+        torch.autocast,
+        "cuda",
+        dtype=torch.bfloat16,
+        enabled=args.bf16,
+        cache_enabled=not model.module.backbone.cuda_graph,
     )
 
-    backbone_params = dict()
-    non_backbone_params = dict()
+    backbone_params = list()
+    non_backbone_params = list()
     for n, p in model.named_parameters():
         if "backbone" in n:
-            backbone_params[n] = p
+            backbone_params.append(p)
         else:
-            non_backbone_params[n] = p
-
-    optimizer = torch.optim.AdamW(
-        [
-            {"params": non_backbone_params.values()},
-            {"params": backbone_params.values(), "lr": args.backbone_lr},
-        ],
-        lr=args.lr,
-        weight_decay=args.weight_decay,
-    )
+            non_backbone_params.append(p)
+
+    param_groups = [
+        {"params": non_backbone_params},
+        {"params": backbone_params, "lr": args.backbone_lr},
+    ]
+    try:
+        optimizer = torch.optim.AdamW(
+            param_groups, lr=args.lr, weight_decay=args.weight_decay, fused=True
+        )
+    except TypeError:
+        # fused AdamW is not available in older PyTorch releases
+        optimizer = torch.optim.AdamW(
+            param_groups, lr=args.lr, weight_decay=args.weight_decay, foreach=True
+        )
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, args.lr_drop, gamma=0.25)
     if args.resume_training:
-        checkpoint = torch.load(os.path.join(args.model_path, f"{args.model_name}.pth"))
+        # read the checkpoint on rank 0 only and broadcast it to the other ranks
+        checkpoint = [None]
+        if rank == 0:
+            checkpoint[0] = torch.load(
+                os.path.join(args.model_path, f"{args.model_name}.pth"),
+                map_location="cpu",
+            )
+        dist.broadcast_object_list(checkpoint, src=0)
+        checkpoint = checkpoint[0]
         model.load_state_dict(checkpoint["model"])
         start_epoch = checkpoint["epoch"]
         best = checkpoint["best_val_ae"]
@@ -98,152 +149,191 @@ def train(args):
         num_objects=args.num_objects,
         tiling_p=args.tiling_p,
     )
-    train_loader = DataLoader(
-        train,
-        sampler=DistributedSampler(train),
+    loader_kwargs = dict(
         batch_size=args.batch_size,
-        drop_last=True,
         num_workers=args.num_workers,
         collate_fn=pad_collate,
+        pin_memory=True,
+        worker_init_fn=seed_worker,
+    )
+    if args.num_workers > 0:
+        # keep workers alive across epochs, a bounded prefetch limits pinned memory
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+    train_loader = DataLoader(
+        train,
+        sampler=DistributedSampler(train, shuffle=True, drop_last=True),
+        drop_last=True,
+        **loader_kwargs,
     )
     val_loader = DataLoader(
         val,
-        sampler=DistributedSampler(val),
-        batch_size=args.batch_size,
+        sampler=DistributedSampler(val, shuffle=False, drop_last=False),
         drop_last=False,
-        num_workers=args.num_workers,
-        collate_fn=pad_collate,
+        **loader_kwargs,
     )
 
+    # gt boxes are given at image_size, the detection targets live at 512x512
+    target_size = (512, 512)
+    box_scale = target_size[0] / args.image_size
+
+    train_prefetcher = Prefetcher(train_loader, device, torch.channels_last)
+    val_prefetcher = Prefetcher(val_loader, device, torch.channels_last)
+
+    # epoch statistics live in one buffer and are accumulated through views
+    stats = torch.zeros(5, device=device)
+
+    # checkpoints are snapshotted to the host and written in the background,
+    # result() re-raises any error from torch.save in the training thread
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    save_futures = []
+    n_train, n_val = len(train), len(val)
+
     print(rank)
     for epoch in range(start_epoch + 1, args.epochs + 1):
         if rank == 0:
             start = perf_counter()
-        train_loss = torch.tensor(0.0).to(device)
-        val_loss = torch.tensor(0.0).to(device)
-        train_ae = torch.tensor(0.0).to(device)
-        val_ae = torch.tensor(0.0).to(device)
-        val_rmse = torch.tensor(0.0).to(device)
+        stats.zero_()
+        train_loss, val_loss, val_rmse, train_ae, val_ae = stats.unbind()
 
         train_loader.sampler.set_epoch(epoch)
         model.train()
 
-        for img, bboxes, img_name, gt_bboxes, density_map in train_loader:
-            img = img.to(device)
-            bboxes = bboxes.to(device)
-            density_map = density_map.to(device)
-
-            optimizer.zero_grad()
-            _, _, centerness, lrtb = model(img, bboxes)
-
-            lrtb = lrtb * 512
-            location = compute_location(lrtb)
-            targets = (
-                BoxList(gt_bboxes, (args.image_size, args.image_size), mode="xyxy")
-                .to(device)
-                .resize((512, 512))
-            )
-
-            # obtain the number of objects in batch
-            with torch.no_grad():
-                num_objects = density_map.sum()
-                dist.all_reduce(num_objects)
-            det_loss = det_criterion(location, lrtb, targets) / num_objects
-            main_loss = criterion(centerness, density_map, num_objects)
-
-            loss = main_loss + det_loss
-            loss.backward()
-            if args.max_grad_norm > 0:
-                nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
-            optimizer.step()
-
-            train_loss += main_loss * img.size(0)
-            train_ae += torch.abs(
-                density_map.flatten(1).sum(dim=1) - centerness.flatten(1).sum(dim=1)
-            ).sum()
-
-        model.eval()
-        with torch.no_grad():
-            index_val = 0
-            for img, bboxes, img_name, gt_bboxes, density_map in val_loader:
-                img = img.to(device)
-                bboxes = bboxes.to(device)
-                density_map = density_map.to(device)
-
-                optimizer.zero_grad()
-
-                _, _, centerness, lrtb = model(img, bboxes)
+        optimizer.zero_grad(set_to_none=True)
+        n_steps = len(train_prefetcher)
+        for step, batch in enumerate(train_prefetcher):
+            img, bboxes, img_name, gt_bboxes, density_map, gt_lengths = batch
+            # obtain the number of objects in batch, overlapped with the forward
+            num_objects = density_map.sum()
+            num_objects_handle = dist.all_reduce(num_objects, async_op=True)
+
+            # skip the gradient AllReduce on all but the last accumulation step,
+            # the last batch of the epoch closes a possibly shorter group
+            sync_step = (step + 1) % args.grad_accum_steps == 0 or step + 1 == n_steps
+            group_start = step - step % args.grad_accum_steps
+            accum_steps = min(args.grad_accum_steps, n_steps - group_start)
+            with contextlib.nullcontext() if sync_step else model.no_sync():
+                with autocast():
+                    _, _, centerness, lrtb = model(img, bboxes)
+                # losses are computed in fp32
+                centerness, lrtb = centerness.float(), lrtb.float()
 
                 lrtb = lrtb * 512
                 location = compute_location(lrtb)
-                targets = (
-                    BoxList(gt_bboxes, (args.image_size, args.image_size), mode="xyxy")
-                    .to(device)
-                    .resize((512, 512))
-                )
+                targets = gt_bboxes * box_scale
 
-                # obtain the number of objects in batch
-                with torch.no_grad():
-                    num_objects = density_map.sum()
-                    dist.all_reduce(num_objects)
-                det_loss = det_criterion(location, lrtb, targets)
+                num_objects_handle.wait()
+                det_loss = (
+                    det_criterion(location, lrtb, targets, gt_lengths, target_size)
+                    / num_objects
+                )
                 main_loss = criterion(centerness, density_map, num_objects)
 
                 loss = main_loss + det_loss
-                val_loss += loss
-                val_ae += torch.abs(
-                    density_map.flatten(1).sum(dim=1) - centerness.flatten(1).sum(dim=1)
-                ).sum()
-                val_rmse += torch.pow(
-                    density_map.flatten(1).sum(dim=1)
-                    - centerness.flatten(1).sum(dim=1),
-                    2,
-                ).sum()
+                (loss / accum_steps).backward()
 
+            if sync_step:
                 if args.max_grad_norm > 0:
                     nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
                 optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+
+            train_loss += main_loss.detach() * img.size(0)
+            train_ae += ae_and_sqe(density_map, centerness.detach())[0]
 
-        dist.all_reduce(train_loss)
-        dist.all_reduce(val_loss)
-        dist.all_reduce(val_rmse)
-        dist.all_reduce(train_ae)
-        dist.all_reduce(val_ae)
+        validate = epoch % args.val_every == 0 or epoch == args.epochs
+        if validate:
+            model.eval()
+            with torch.no_grad():
+                index_val = 0
+                for batch in val_prefetcher:
+                    img, bboxes, img_name, gt_bboxes, density_map, gt_lengths = batch
+                    # obtain the number of objects in batch, overlapped with the forward
+                    num_objects = density_map.sum()
+                    num_objects_handle = dist.all_reduce(num_objects, async_op=True)
+
+                    with autocast():
+                        _, _, centerness, lrtb = model(img, bboxes)
+                    centerness, lrtb = centerness.float(), lrtb.float()
+
+                    lrtb = lrtb * 512
+                    location = compute_location(lrtb)
+                    targets = gt_bboxes * box_scale
+
+                    num_objects_handle.wait()
+                    det_loss = det_criterion(
+                        location, lrtb, targets, gt_lengths, target_size
+                    )
+                    main_loss = criterion(centerness, density_map, num_objects)
+
+                    loss = main_loss + det_loss
+                    val_loss += loss
+                    ae, sqe = ae_and_sqe(density_map, centerness)
+                    val_ae += ae
+                    val_rmse += sqe
+
+        # reduce all epoch statistics with a single collective
+        dist.all_reduce(stats)
 
         scheduler.step()
 
         if rank == 0:
             end = perf_counter()
-            best_epoch = False
-            if val_rmse.item() / len(val) < best:
-                best = val_rmse.item() / len(val)
-                checkpoint = {
-                    "epoch": epoch,
-                    "model": model.state_dict(),
-                    "optimizer": optimizer.state_dict(),
-                    "scheduler": scheduler.state_dict(),
-                    "best_val_ae": val_ae.item() / len(val),
-                }
-
-                torch.save(
-                    checkpoint, os.path.join(args.model_path, f"{args.model_name}.pth")
+            # a single device-to-host copy for all epoch statistics
+            train_loss, val_loss, val_rmse, train_ae, val_ae = stats.tolist()
+            best_epoch = validate and val_rmse / n_val < best
+            if best_epoch:
+                best = val_rmse / n_val
+            last_epoch = epoch % args.ckpt_every == 0 or epoch == args.epochs
+            if best_epoch or last_epoch:
+                for future in save_futures:
+                    future.result()
+                save_futures = []
+                checkpoint = to_cpu(
+                    {
+                        "epoch": epoch,
+                        "model": model.state_dict(),
+                        "optimizer": optimizer.state_dict(),
+                        "scheduler": scheduler.state_dict(),
+                        # the tracked best, which is what resuming compares against
+                        "best_val_ae": best,
+                    }
+                )
+            if best_epoch:
+                save_futures.append(
+                    save_executor.submit(
+                        torch.save,
+                        checkpoint,
+                        os.path.join(args.model_path, f"{args.model_name}.pth"),
+                    )
+                )
+            if last_epoch:
+                save_futures.append(
+                    save_executor.submit(
+                        torch.save,
+                        checkpoint,
+                        os.path.join(args.model_path, f"{args.model_name}_last.pth"),
+                    )
                 )
-                best_epoch = True
-            torch.save(
-                checkpoint, os.path.join(args.model_path, f"{args.model_name}_last.pth")
-            )
 
+            # keep the original field order, val fields are left out when skipped
+            log = [f"Epoch: {epoch}", f"Train loss: {train_loss:.3f}"]
+            if validate:
+                log.append(f"Val loss: {val_loss:.3f}")
+            log.append(f"Train MAE: {train_ae / n_train:.3f}")
+            if validate:
+                log += [
+                    f"Val MAE: {val_ae / n_val:.3f}",
+                    f"Val RMSE: {math.sqrt(val_rmse / n_val):.2f}",
+                ]
             print(
-                f"Epoch: {epoch}",
-                f"Train loss: {train_loss.item():.3f}",
-                f"Val loss: {val_loss.item():.3f}",
-                f"Train MAE: {train_ae.item() / len(train):.3f}",
-                f"Val MAE: {val_ae.item() / len(val):.3f}",
-                f"Val RMSE: {torch.sqrt(val_rmse / len(val)).item():.2f}",
+                *log,
                 f"Epoch time: {end - start:.3f} seconds",
                 "best" if best_epoch else "",
             )
 
+    for future in save_futures:
+        future.result()
+    save_executor.shutdown()
     dist.destroy_process_group()
 
 
@@ -12,14 +12,10 @@ from torch import nn
 from torch.utils.data import DataLoader, DistributedSampler
 from torch.nn.parallel import DistributedDataParallel
 from torch import distributed as dist
-from utils.data import pad_collate
+from utils.data import pad_collate, seed_worker
 import numpy as np
 import random
 
-torch.manual_seed(0)
-random.seed(0)
-np.random.seed(0)
-
 DATASETS = {"fsc147": FSC147Dataset}
 
 
@@ -34,6 +30,11 @@ def train(args):
         rank = int(os.environ["RANK"])
         gpu = int(os.environ["LOCAL_RANK"])
 
+    # seed by rank so that ranks do not draw identical augmentations
+    torch.manual_seed(rank)
+    random.seed(rank)
+    np.random.seed(rank)
+
     torch.cuda.set_device(gpu)
     device = torch.device(gpu)
 
@@ -63,7 +64,15 @@ def train(args):
     )
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, args.lr_drop, gamma=0.25)
     if args.resume_training:
-        checkpoint = torch.load(os.path.join(args.model_path, f"{args.model_name}.pth"))
+        # read the checkpoint on rank 0 only and broadcast it to the other ranks
+        checkpoint = [None]
+        if rank == 0:
+            checkpoint[0] = torch.load(
+                os.path.join(args.model_path, f"{args.model_name}.pth"),
+                map_location="cpu",
+            )
+        dist.broadcast_object_list(checkpoint, src=0)
+        checkpoint = checkpoint[0]
         model.load_state_dict(checkpoint["model"], strict=False)
 
     start_epoch = 0
@@ -100,6 +109,7 @@ def train(args):
         drop_last=True,
         num_workers=args.num_workers,
         collate_fn=pad_collate,
+        worker_init_fn=seed_worker,
     )
     val_loader = DataLoader(
         val,
@@ -108,6 +118,7 @@ def train(args):
         drop_last=False,
         num_workers=args.num_workers,
         collate_fn=pad_collate,
+        worker_init_fn=seed_worker,
     )
 
     print(rank)
@@ -123,7 +134,7 @@ def train(args):
         train_loader.sampler.set_epoch(epoch)
         model.train()
         criterion.train()
-        for img, bboxes, img_name, gt_bboxes, _ in train_loader:
+        for img, bboxes, img_name, gt_bboxes, _, _ in train_loader:
             img = img.to(device)
             bboxes = bboxes.to(device)
             gt_bboxes = gt_bboxes.to(device)
@@ -187,12 +198,11 @@ def train(args):
         criterion.eval()
         model.eval()
         with torch.no_grad():
-            for img, bboxes, img_name, gt_bboxes, _ in val_loader:
+            for img, bboxes, img_name, gt_bboxes, _, _ in val_loader:
                 img = img.to(device)
                 bboxes = bboxes.to(device)
                 gt_bboxes = gt_bboxes.to(device)
 
-                optimizer.zero_grad()
                 outputs, ref_points, centerness, outputs_coord = model(img, bboxes)
 
                 losses = []
@@ -250,10 +260,6 @@ def train(args):
                 val_ae += torch.abs(num_objects_gt - num_objects_pred).sum()
                 val_rmse += torch.pow(num_objects_gt - num_objects_pred, 2).sum()
 
-                if args.max_grad_norm > 0:
-                    nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
-                optimizer.step()
-
         dist.all_reduce(train_loss)
         dist.all_reduce(val_loss)
         dist.all_reduce(val_rmse)
@@ -1,6 +1,13 @@
 import argparse
 
 
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"expected an integer >= 1, got {value}")
+    return value
+
+
 def get_argparser():
 
     parser = argparse.ArgumentParser("LOCA parser", add_help=False)
@@ -18,13 +25,31 @@ def get_argparser():
     parser.add_argument("--kernel_dim", default=1, type=int)
     parser.add_argument("--num_objects", default=3, type=int)
     parser.add_argument("--epochs", default=200, type=int)
+    parser.add_argument(
+        "--val_every",
+        default=1,
+        type=positive_int,
+        help="Epochs between validation runs",
+    )
     parser.add_argument("--resume_training", action="store_true")
+    parser.add_argument(
+        "--ckpt_every",
+        default=10,
+        type=positive_int,
+        help="Epochs between saves of the last checkpoint",
+    )
     parser.add_argument("--lr", default=1e-4, type=float)
     parser.add_argument("--backbone_lr", default=0, type=float)
     parser.add_argument("--lr_drop", default=200, type=int)
     parser.add_argument("--weight_decay", default=1e-4, type=float)
     parser.add_argument("--batch_size", default=1, type=int)
     parser.add_argument("--num_workers", default=8, type=int)
+    parser.add_argument(
+        "--grad_accum_steps",
+        default=1,
+        type=positive_int,
+        help="Micro-batches accumulated per optimizer step",
+    )
     parser.add_argument("--max_grad_norm", default=0.1, type=float)
     parser.add_argument("--tiling_p", default=0.5, type=float)
     parser.add_argument("--zero_shot", action="store_true")
@@ -49,5 +74,20 @@ def get_argparser():
     )
     parser.add_argument("--focal_alpha", default=0.25, type=float)
     parser.add_argument("--output_masks", action="store_true")
+    parser.add_argument(
+        "--cuda_graph",
+        action="store_true",
+        help="Replay the frozen backbone forward from captured CUDA graphs",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the model with mode='reduce-overhead'",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Run the model forward under bfloat16 autocast",
+    )
 
     return parser
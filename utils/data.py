@@ -1,6 +1,7 @@
 import os
 import json
 import argparse
+import random
 from PIL import Image
 import numpy as np
 
@@ -18,12 +19,64 @@ def pad_collate(batch):
     if None in gt_bboxes:
         return None, None, None, torch.stack(image_names), None, None
     gt_bboxes_pad = pad_sequence(gt_bboxes, batch_first=True, padding_value=0)
+    gt_lengths = torch.tensor([len(b) for b in gt_bboxes])
     img = torch.stack(img)
     bboxes = torch.stack(bboxes)
     image_names = torch.stack(image_names)
     dmaps = torch.stack(dmap)
     gt_bboxes = gt_bboxes_pad
-    return img, bboxes, image_names, gt_bboxes, dmaps
+    return img, bboxes, image_names, gt_bboxes, dmaps, gt_lengths
+
+
+def seed_worker(worker_id):
+    # derive numpy and python seeds from the per-worker torch seed
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+class Prefetcher:
+    """Copies batches to the GPU on a side stream, one step ahead of the loop."""
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, t):
+        if not torch.is_tensor(t):
+            return t
+        if t.dim() == 4:
+            return t.to(
+                self.device, non_blocking=True, memory_format=self.memory_format
+            )
+        return t.to(self.device, non_blocking=True)
+
+    def preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return tuple(self.to_device(t) for t in batch)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        batch = self.preload(loader_iter)
+        while batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            for t in batch:
+                if torch.is_tensor(t):
+                    # the tensors were allocated on the side stream
+                    t.record_stream(current_stream)
+            next_batch = self.preload(loader_iter)
+            yield batch
+            batch = next_batch
 
 
 def xywh_to_x1y1x2y2(xywh):
@@ -3,6 +3,16 @@ import torch.nn.functional as F
 from torch import nn
 from utils import box_ops
 import copy
+from typing import Tuple
+
+
+@torch.jit.script
+def ae_and_sqe(
+    density_map: torch.Tensor, output: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # absolute and squared count errors summed over the batch
+    diff = density_map.flatten(1).sum(1) - output.flatten(1).sum(1)
+    return diff.abs().sum(), (diff * diff).sum()
 
 
 class ObjectNormalizedL2Loss(nn.Module):
@@ -28,7 +38,7 @@ class Detection_criterion(nn.Module):
         self.strides = fpn_strides
         self.radius = pos_radius
 
-    def prepare_target(self, points, targets):
+    def prepare_target(self, points, targets, target_lengths, image_size):
         ex_size_of_interest = []
 
         for i, point_per_level in enumerate(points):
@@ -41,7 +51,12 @@ class Detection_criterion(nn.Module):
         n_point_per_level = [len(point_per_level) for point_per_level in points]
         point_all = torch.cat(points, dim=0)
         label, box_target = self.compute_target_for_location(
-            point_all, targets, ex_size_of_interest, n_point_per_level
+            point_all,
+            targets,
+            target_lengths,
+            ex_size_of_interest,
+            n_point_per_level,
+            image_size,
         )
 
         for i in range(len(label)):
@@ -116,20 +131,39 @@ class Detection_criterion(nn.Module):
         return is_in_boxes
 
     def compute_target_for_location(
-        self, locations, targets, sizes_of_interest, n_point_per_level
+        self,
+        locations,
+        targets,
+        target_lengths,
+        sizes_of_interest,
+        n_point_per_level,
+        image_size,
     ):
         labels = []
         box_targets = []
         xs, ys = locations[:, 0], locations[:, 1]
+        height, width = image_size
+        # targets are padded to the largest box count in the batch
+        is_box = (
+            torch.arange(targets.shape[1], device=targets.device)[None]
+            < target_lengths[:, None]
+        )
         for i in range(len(targets)):
-            targets_per_img = targets[i]
-            targets_per_img = targets_per_img.clip(remove_empty=True)
-            assert targets_per_img.mode == "xyxy"
-            targets_per_img = targets_per_img[:50]
-            bboxes = targets_per_img.box
+            # clip xyxy boxes to the image and drop padding and empty boxes
+            bboxes = targets[i].clone()
+            bboxes[:, 0::2].clamp_(min=0, max=width - 1)
+            bboxes[:, 1::2].clamp_(min=0, max=height - 1)
+            keep = (
+                is_box[i]
+                & (bboxes[:, 3] > bboxes[:, 1])
+                & (bboxes[:, 2] > bboxes[:, 0])
+            )
+            bboxes = bboxes[keep][:50]
 
-            labels_per_img = torch.tensor([1] * len(bboxes)).to(locations.device)
-            area = targets_per_img.area()
+            labels_per_img = torch.ones(
+                len(bboxes), dtype=torch.long, device=locations.device
+            )
+            area = (bboxes[:, 2] - bboxes[:, 0] + 1) * (bboxes[:, 3] - bboxes[:, 1] + 1)
 
             l = xs[:, None] - bboxes[:, 0][None]
             t = ys[:, None] - bboxes[:, 1][None]
@@ -181,9 +215,11 @@ class Detection_criterion(nn.Module):
 
         return torch.sqrt(centerness)
 
-    def forward(self, locations, box_pred, targets):
+    def forward(self, locations, box_pred, targets, target_lengths, image_size):
         batch = box_pred[0].shape[0]
-        labels, box_targets = self.prepare_target(locations, targets)
+        labels, box_targets = self.prepare_target(
+            locations, targets, target_lengths, image_size
+        )
         box_flat = []
 
         labels_flat = []